@@ -15,42 +15,353 @@ Note: Playwright Python et ses binaires doivent être installés (voir README.md
 import sys
 import json
 import argparse
+import atexit
+import contextlib
+import functools
+import threading
 from pathlib import Path
 import time
-import traceback
-import requests
 import os
+import re
 import tempfile
-import mimetypes
+from datetime import datetime
+from urllib.parse import urlsplit
 
-from playwright.sync_api import sync_playwright
+try:
+    # parseur JSON plus rapide si disponible (optionnel)
+    from orjson import loads as _json_loads
+except ImportError:
+    _json_loads = json.loads
+
+# requests, playwright, mimetypes et concurrent.futures sont importés à la première utilisation
+# (démarrage plus rapide pour --help, --dry et les erreurs de config)
 
 CONFIG_PATH = Path(__file__).parent / 'config.json'
 
+# texte des boutons par étape quand aucun sélecteur n'est configuré (compilé une seule fois)
+STEP_TEXT_RE = {
+    'renew': re.compile(r'Renouvel|Renew', re.I),
+    'create_invoice': re.compile(r'Créer une facture|Create Invoice', re.I),
+    'pay': re.compile(r'Payer|Pay', re.I),
+}
+
+# marqueur attendu après le click d'une étape quand le bouton suivant ne suffit pas (surchargeable via `markers`):
+# après 'create_invoice', le bloc des totaux doit être rendu avant d'extraire le montant
+STEP_MARKERS = {
+    'create_invoice': '.space-y-3 .flex.justify-between, .invoice-amount, .total',
+}
+
+# conteneurs où le site affiche ses messages (alertes, toasts, modals)
+RESTRICTION_SELECTORS = ('[role="alert"]', '.alert', '.alert-danger', '.toast', '.modal', '.modal-body', '.notification', '.notice')
+# sélecteur de la traversée (conteneurs + h3) joint une seule fois, pas à chaque détection
+RESTRICTION_SCAN_SELECTOR = ', '.join((*RESTRICTION_SELECTORS, 'h3'))
+# détection "Renewal Restricted" exécutée dans la page en un seul appel: texte du body,
+# puis conteneurs de messages et titres h3 (ex: en-tête du modal); l'inverse avec `modal`
+RESTRICTION_DETECT_JS = """([src, scan, sels, watch, modal]) => {
+    // watch: compteur de mutations lu par RESTRICTION_CHANGED_JS après le click; texte, nœuds et attributs
+    // de visibilité (un modal déjà dans le DOM peut être affiché par un simple changement de classe)
+    if (watch) {
+        if (window.__hcObserver) window.__hcObserver.disconnect();
+        window.__hcMutations = 0;
+        window.__hcObserver = new MutationObserver(() => { window.__hcMutations++; });
+        window.__hcObserver.observe(document.documentElement, {
+            subtree: true, childList: true, characterData: true,
+            attributes: true, attributeFilter: ['class', 'style', 'hidden', 'open'],
+        });
+    }
+    // une seule alternation (RESTRICTED_RE) pour le body, les conteneurs et les h3
+    const re = new RegExp(src, 'i');
+    const find = (t) => {
+        const m = (t || '').match(re);
+        return m ? m[0].toLowerCase() : null;
+    };
+    // conteneur non affiché: display:none, visibility:hidden ou opacity:0 (modal fermé, tooltips
+    // Flowbite `invisible opacity-0`); options des deux générations de checkVisibility
+    const VIS = {checkVisibilityCSS: true, checkOpacity: true, visibilityProperty: true, opacityProperty: true};
+    const hidden = (el) => el.hidden || (el.checkVisibility ? !el.checkVisibility(VIS) : false);
+    // texte affiché du body (innerText: sans le texte des éléments non rendus ni visibility:hidden)
+    const bodyScan = () => {
+        const c = document.body ? find(document.body.innerText) : null;
+        return c ? {found: true, why: 'matched_text:' + c} : null;
+    };
+    // conteneurs et h3 en une seule traversée du DOM (scan: RESTRICTION_SCAN_SELECTOR)
+    // ordre du document: un conteneur sans message ne peut pas en contenir un (texte inclus dans le
+    // sien): ses descendants (ex: .modal-body dans .modal) sont ignorés sans relire leur texte
+    const nodeScan = () => {
+        let miss = null;
+        for (const node of document.querySelectorAll(scan)) {
+            if (miss && miss.contains(node)) continue;
+            // conteneur non rendu: traité comme sans message (ses descendants non plus ne sont pas affichés)
+            const c = hidden(node) ? null : find(node.innerText);
+            if (!c) { miss = node; continue; }
+            if (node.matches('h3')) return {found: true, why: 'h3:' + c};
+            return {found: true, why: 'sel:' + sels.find((s) => node.matches(s)) + ':' + c};
+        }
+        return null;
+    };
+    // après un click, le refus s'affiche plutôt en toast/modal: conteneurs d'abord, sans lire tout le body
+    const res = modal ? (nodeScan() || bodyScan()) : (bodyScan() || nodeScan());
+    return res || {found: false, why: null};
+}"""
+
+# le DOM a-t-il changé depuis la détection avec `watch`? (nouvelle page: compteur absent -> oui)
+RESTRICTION_CHANGED_JS = """() => {
+    if (window.__hcObserver) window.__hcObserver.disconnect();
+    return window.__hcMutations !== 0;
+}"""
+
+# derniers recours pour le montant, appliqués à l'extrait de page (0,00 € / 12.34)
+SNIPPET_AMOUNT_EUR_RE = re.compile(r"(0[,.]0{1,2}|\d+[,.]\d{2})\s*€")
+SNIPPET_AMOUNT_RE = re.compile(r"(0[,.]0{1,2}|\d+[,.]\d{2})")
+# partie numérique d'un montant normalisé (parse_amount)
+NUM_RE = re.compile(r"[0-9]+\.?[0-9]*")
+# normalisation du montant en une passe (str.translate): espaces et € retirés, virgule décimale -> point
+AMOUNT_TRANSLATE = str.maketrans({'\u00A0': None, ' ': None, '€': None, ',': '.'})
+
+# heuristiques de secours quand le sélecteur d'une étape ne trouve rien (attributs du modal de renouvellement)
+FALLBACK_SELECTORS = ('[data-modal-target*="renewService"]', '[data-modal-toggle*="renewService"]')
+# exécuté dans la page: 1) bouton/lien dont le texte contient "renouvel", 2) FALLBACK_SELECTORS,
+# sinon extrait du texte autour de "renouvel|renew" pour le diagnostic
+FALLBACK_SCAN_JS = """(sels) => {
+    const prev = document.querySelector('[data-hc-fallback]');
+    if (prev) prev.removeAttribute('data-hc-fallback');
+    const mark = (el, how) => { el.setAttribute('data-hc-fallback', '1'); return {found: true, matched: how}; };
+    for (const el of document.querySelectorAll('button, a, [role="button"]')) {
+        if (/renouvel/i.test(el.textContent || '')) return mark(el, 'text:renouvel');
+    }
+    for (const s of sels) {
+        const el = document.querySelector(s);
+        if (el) return mark(el, s);
+    }
+    const body = document.body ? document.body.innerText : '';
+    const m = body.match(/renouvel|renew/i);
+    if (!m) return {found: false, snippet: null};
+    const start = Math.max(0, m.index - 120);
+    return {found: false, snippet: body.slice(start, start + 400)};
+}"""
+
+# types de ressources inutiles au flux de renouvellement (les feuilles de style sont gardées:
+# la visibilité des boutons/modals en dépend)
+BLOCKED_RESOURCE_TYPES = ('image', 'font', 'media')
+# analytics / traqueurs tiers bloqués au niveau réseau (surchargeable via `blocked_hosts`)
+BLOCKED_HOSTS = (
+    'google-analytics.com',
+    'googletagmanager.com',
+    'doubleclick.net',
+    'hotjar.com',
+    'clarity.ms',
+    'facebook.net',
+)
+
+# marqueurs d'une page interstitielle de challenge Cloudflare (Security Verification / Just a moment):
+# titre ou en-tête de la page. Le widget Turnstile seul (iframe, data-sitekey) est aussi intégré aux
+# pages normales du site et ne compte pas
+CHALLENGE_SELECTOR = 'h1, h2'
+CHALLENGE_TEXT_RE = re.compile(r'Security Verification|Just a moment', re.I)
+# marqueurs de l'interstitiel dans le HTML (scripts cf_chl_*, titre), une seule passe insensible à la casse
+CHALLENGE_RE = re.compile(r'cf_chl_opt|cf_chl_prog|<title>\s*(?:security verification|just a moment)', re.I)
+# début du HTML découpé dans la page (seul l'extrait transite par CDP)
+HEAD_PROBE_JS = """(n) => document.documentElement ? document.documentElement.outerHTML.slice(0, n) : ''"""
+# prédicat complet: titre/en-tête de l'interstitiel ou marqueurs dans le HTML, une seule passe dans la page
+CHALLENGE_PROBE_JS = """([sel, textSrc, src]) => {
+    const text = new RegExp(textSrc, 'i');
+    if (text.test(document.title)) return true;
+    for (const h of document.querySelectorAll(sel)) {
+        if (text.test(h.textContent)) return true;
+    }
+    const html = document.documentElement ? document.documentElement.outerHTML : '';
+    return new RegExp(src, 'i').test(html);
+}"""
+
+# messages affichés par le site quand le renouvellement est refusé
+RESTRICTION_CHECKS = (
+    'renewal restricted',
+    'you can only renew your free service',
+    'renouvellement restreint',
+    'ne peut être renouvelé',
+    'vous ne pouvez renouveler',
+    'you can only renew',
+)
+RESTRICTED_RE = re.compile('|'.join(re.escape(c) for c in RESTRICTION_CHECKS), re.I)
+# détecteur installé une fois par document (context.add_init_script), arguments figés: chaque
+# contrôle n'envoie plus que RESTRICTION_CALL_JS; null si absent (page ouverte sans le script)
+RESTRICTION_INSTALL_JS = "window.__hcDetectRestricted = (watch, modal) => (%s)(%s.concat([watch, modal]))" % (
+    RESTRICTION_DETECT_JS, json.dumps([RESTRICTED_RE.pattern, RESTRICTION_SCAN_SELECTOR, list(RESTRICTION_SELECTORS)]))
+RESTRICTION_CALL_JS = "([watch, modal]) => window.__hcDetectRestricted ? window.__hcDetectRestricted(watch, modal) : null"
+
+# page interactive: document chargé et au moins un élément cliquable présent
+PAGE_READY_JS = "() => document.readyState === 'complete' && !!document.querySelector('button, a')"
+
+# flags réduisant mémoire, sous-processus et tâches de fond de Chromium (VPS peu dotés)
+CHROMIUM_ARGS = (
+    "--no-sandbox",
+    "--disable-blink-features=AutomationControlled",
+    "--disable-dev-shm-usage",
+    "--disable-gpu",
+    "--disable-extensions",
+    "--disable-background-networking",
+    "--disable-background-timer-throttling",
+    "--disable-backgrounding-occluded-windows",
+    "--disable-renderer-backgrounding",
+    "--disable-breakpad",
+    "--disable-component-update",
+    "--disable-features=Translate,MediaRouter,OptimizationHints",
+    "--disable-sync",
+    "--metrics-recording-only",
+    "--mute-audio",
+    "--no-first-run",
+    "--no-default-browser-check",
+)
+
+# lignes label / valeur du récapitulatif de facture ('Sous-total', 'Total')
+TOTALS_ROW_SELECTOR = '.space-y-3 .flex.justify-between'
+# conteneurs du montant sur la page facture, par ordre de préférence (`strong`, trop générique, en dernier)
+AMOUNT_SELECTORS = ('.invoice-amount', '.amount', '.price', '.total', 'strong')
+# détection du montant exécutée dans la page, par ordre de fiabilité:
+# 1) lignes Sous-total/Total, 2) voisin d'un libellé "Total", 3) montant suivant "Total" dans le texte,
+# 4) conteneurs AMOUNT_SELECTORS, 5) mention de gratuité -> 0.00,
+# 6) montants du texte, celui le plus proche d'un label utile (total, montant, price...): O(C log L)
+AMOUNT_DETECT_JS = """([rowSel, sels]) => {
+    const clean = (t) => (t || '').trim();
+    // un résultat sans chiffre (ex: '—') ne termine pas la recherche: méthode suivante
+    const num = (t) => /[0-9]/.test(t);
+    for (const row of document.querySelectorAll(rowSel)) {
+        const parts = row.querySelectorAll('div');
+        if (parts.length >= 2 && /total/i.test(parts[0].textContent || '') && num(parts[1].textContent || '')) return {amount: clean(parts[1].textContent), how: 'totals'};
+    }
+    const body = document.body;
+    if (!body) return {amount: '', how: null};
+    const walker = document.createTreeWalker(body, NodeFilter.SHOW_TEXT);
+    for (let n = walker.nextNode(); n; n = walker.nextNode()) {
+        if (!/Total|Sous-total|Sous total/i.test(n.nodeValue)) continue;
+        const el = n.parentElement;
+        const sib = el && (el.nextElementSibling || (el.parentElement && el.parentElement.querySelector('div:last-child')));
+        if (sib && num(sib.textContent || '')) return {amount: clean(sib.textContent), how: 'total_label'};
+        break;
+    }
+    const text = body.innerText || '';
+    let m = text.match(/(Total|Sous-total|Sous total)[\\s\\S]{0,60}?(€?\\s?\\d[0-9\\s.,]*\\d)/i);
+    if (m) return {amount: clean(m[2]), how: 'total_text'};
+    for (const s of sels) {
+        const el = document.querySelector(s);
+        if (!el) continue;
+        const t = clean(el.textContent);
+        if (s === 'strong' ? /[0-9][,.][0-9]{2}/.test(t) : /[0-9€$£]/.test(t)) return {amount: t, how: s};
+    }
+    if (/\\b(gratuit|gratuitement|free|no charge|without charge)\\b/i.test(text)) return {amount: '0.00', how: 'free'};
+    // positions de tous les labels relevées une fois (une passe par label), triées: le score d'un
+    // candidat est la distance au label le plus proche (+/- 120 caractères), trouvé par dichotomie
+    const labels = ['total', 'montant', 'price', 'amount', 'due', 'subtotal', 'balance', 'prix'];
+    const labelPos = [];
+    for (const lab of labels) for (const l of text.matchAll(new RegExp(lab, 'gi'))) labelPos.push(l.index);
+    labelPos.sort((a, b) => a - b);
+    const score = (idx) => {
+        let lo = 0, hi = labelPos.length;
+        while (lo < hi) { const mid = (lo + hi) >> 1; if (labelPos[mid] < idx) lo = mid + 1; else hi = mid; }
+        let d = 999999;
+        if (lo < labelPos.length) d = labelPos[lo] - idx;
+        if (lo > 0) d = Math.min(d, idx - labelPos[lo - 1]);
+        return d <= 120 ? d : 999999;
+    };
+    const pats = [
+        /\\d{1,3}(?:[\\d\\s.,]*\\d)?[.,]\\d{2}\\s*(?:€|eur|\\$|usd|£|gbp)?/gi,
+        /(?:€|\\$|£)\\s*\\d+[.,]\\d{2}/g,
+    ];
+    let chosen = null, best = null;
+    for (const re of pats) {
+        for (const c of text.matchAll(re)) {
+            const sc = score(c.index);
+            if (best === null || sc < best) { best = sc; chosen = c[0].trim(); }
+        }
+    }
+    return {amount: chosen || '', how: chosen ? 'scored' : null};
+}"""
+
+_CDP_SPAWN_LOCK = threading.Lock()
+_LAST_RUN_LOCK = threading.Lock()
+_LOG_LOCK = threading.Lock()
+# pauses --debug: l'événement est levé par SIGUSR1 ou Entrée (voir _install_debug_resume)
+_DEBUG_STEP = threading.Event()
+_DEBUG_RESUME_SOURCES = None
+DEBUG_WAIT_TIMEOUT = 300
+# qualité JPEG des captures --screen (zone visible)
+SCREENSHOT_JPEG_QUALITY = 60
+SCREENSHOT_MIME = {'.jpg': 'image/jpeg', '.png': 'image/png'}
+
+# session HTTP partagée pour le webhook Discord (keep-alive: une seule poignée de main TLS par run)
+_SESSION = None
+# captures envoyées récemment (chemin -> timestamp), pour ne pas les renvoyer en double
+_LAST_SCREENSHOT_SEND = {}
+# limites Discord d'un message webhook
+DISCORD_MAX_EMBEDS = 10
+DISCORD_MAX_FILES = 10
+DISCORD_MAX_EMBED_CHARS = 6000
+# succès enregistrés dans last_run (min_days_between_runs): pas 'paid_unconfirmed', à retenter au run suivant
+CONFIRMED_RENEW_REASONS = ('paid', 'free_invoice')
+# raisons d'échec déjà signalées par leur propre message (avec raison/capture): pas de résumé final en double
+NOTIFIED_FAILURE_REASONS = ('security_challenge', 'amount_unknown', 'payment_required', 'renewal_restricted_', 'click_error:')
+# envois webhook faits par un thread de fond: les étapes Playwright n'attendent pas le RTT Discord
+_DISCORD_Q = None
+_DISCORD_Q_LOCK = threading.Lock()
+
 
 def load_config():
     if CONFIG_PATH.exists():
-        return json.loads(CONFIG_PATH.read_text())
+        return _json_loads(CONFIG_PATH.read_bytes())
     return {}
 
 
+def _http_session():
+    global _SESSION
+    if _SESSION is None:
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+        _SESSION = requests.Session()
+        # un seul hôte (discord.com) et un seul thread d'envoi (_discord_worker): une connexion keep-alive
+        # suffit; seuls les échecs de connexion sont rejoués (un POST déjà reçu n'est pas renvoyé en double)
+        retry = Retry(total=2, connect=2, read=0, status=0, backoff_factor=0.3)
+        _SESSION.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=1, max_retries=retry))
+        _SESSION.headers.update({'User-Agent': 'hiden-renew/1'})
+        atexit.register(_SESSION.close)
+    return _SESSION
+
+
 def now_str():
-    from datetime import datetime
     return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
 
+def _open_log_file(conf):
+    """Ouvre une seule fois `paths.log_file` et garde le handle dans conf['_log_fh'].
+
+    Bufferisé par ligne: chaque ligne est écrite aussitôt (tail -f, et rien de perdu si le process
+    est tué par SIGTERM/SIGKILL, où atexit ne s'exécute pas).
+    """
+    fh = None
+    try:
+        p = (conf.get('paths', {}) or {}).get('log_file')
+        if p and Path(p).parent.exists():
+            fh = open(p, 'a', buffering=1)
+            atexit.register(fh.close)
+    except Exception:
+        fh = None
+    conf['_log_fh'] = fh
+    return fh
+
+
 def log(msg, conf=None):
     ts = now_str()
     line = f"[{ts}] {msg}"
-    print(line)
-    try:
-        if conf:
-            p = Path(conf.get('paths', {}).get('log_file') or '')
-            if p and p.parent.exists():
-                with open(p, 'a') as f:
-                    f.write(line + "\n")
-    except Exception:
-        pass
+    # verrou: les workers (`max_parallel`) partagent stdout et le fichier de log, pas de lignes entremêlées
+    with _LOG_LOCK:
+        print(line)
+        try:
+            if conf:
+                fh = conf['_log_fh'] if '_log_fh' in conf else _open_log_file(conf)
+                if fh:
+                    fh.write(line + "\n")
+        except Exception:
+            pass
 
 
 def _map_status_color(status):
@@ -64,122 +375,220 @@ def _map_status_color(status):
     return colors.get(status, colors[None])
 
 
-def send_discord(content, conf=None):
-    """Envoie un message compact au webhook Discord.
+def _t(s, l):
+    s = str(s)
+    if len(s) <= l:
+        return s
+    return s[: l - 3] + '...'
+
+
+def _discord_embed(content):
+    """Embed compact (titre, description, couleur, quelques champs utiles) pour un message."""
+    if isinstance(content, dict):
+        title = _t(content.get('title') or content.get('heading') or 'Notification', 80)
+        desc = _t(content.get('description') or '', 400)
+        status = content.get('status') or content.get('level') or content.get('type')
+        color = _map_status_color(status if isinstance(status, str) else None)
+        embed = {'title': title, 'description': desc, 'color': color}
+        # small useful fields only
+        fields = []
+        if content.get('url'):
+            fields.append({'name': 'URL', 'value': _t(content.get('url'), 200), 'inline': False})
+        if content.get('amount') is not None:
+            fields.append({'name': 'Montant', 'value': _t(str(content.get('amount')), 50), 'inline': True})
+        if content.get('reason'):
+            fields.append({'name': 'Raison', 'value': _t(content.get('reason'), 120), 'inline': False})
+        if fields:
+            embed['fields'] = fields
+        return embed
+    return {'title': _t('Notification', 80), 'description': _t(content, 400), 'color': _map_status_color('info')}
+
+
+def _embed_size(embed):
+    return len(embed['title']) + len(embed['description']) + sum(len(f['name']) + len(f['value']) for f in embed.get('fields', ()))
+
+
+@functools.lru_cache(maxsize=16)
+def _attachment_mime(ext):
+    """Type MIME d'une pièce jointe selon son extension; mimetypes (qui lit les tables système au
+    premier appel) n'est consulté que pour les extensions autres que celles des captures."""
+    if ext in SCREENSHOT_MIME:
+        return SCREENSHOT_MIME[ext]
+    import mimetypes
+    return mimetypes.types_map.get(ext) or 'application/octet-stream'
+
+
+def _post_discord(contents, conf=None):
+    """Envoie plusieurs messages en une seule requête webhook (un embed par message).
 
-    Si content contient 'screenshots': list[str] alors les fichiers sont envoyés en attachments.
+    Les 'screenshots' de chaque message sont joints au même POST et affichés dans leur embed.
     """
     try:
         webhook = None
         if conf:
             webhook = conf.get('discord_webhook')
-        if not webhook:
+        if not webhook or not contents:
             return
 
-        def _t(s, l):
-            try:
-                s = str(s)
-            except Exception:
-                s = ''
-            if len(s) <= l:
-                return s
-            return s[: l - 3] + '...'
-
-        # Minimal embed (shorter, moderne)
-        if isinstance(content, str):
-            embed = {'title': _t('Notification', 80), 'description': _t(content, 400), 'color': _map_status_color('info')}
-            payload = {'embeds': [embed]}
-        elif isinstance(content, dict):
-            title = _t(content.get('title') or content.get('heading') or 'Notification', 80)
-            desc = _t(content.get('description') or '', 400)
-            status = content.get('status') or content.get('level') or content.get('type')
-            color = _map_status_color(status if isinstance(status, str) else None)
-            embed = {'title': title, 'description': desc, 'color': color}
-            # small useful fields only
-            fields = []
-            if content.get('url'):
-                fields.append({'name': 'URL', 'value': _t(content.get('url'), 200), 'inline': False})
-            if content.get('amount') is not None:
-                fields.append({'name': 'Montant', 'value': _t(str(content.get('amount')), 50), 'inline': True})
-            if content.get('reason'):
-                fields.append({'name': 'Raison', 'value': _t(content.get('reason'), 120), 'inline': False})
-            if fields:
-                embed['fields'] = fields
-            payload = {'embeds': [embed]}
-        else:
-            payload = {'content': _t(content, 400)}
-
-        # support screenshots attachments
-        screenshots = None
-        if isinstance(content, dict) and content.get('screenshots'):
-            screenshots = content.get('screenshots')
-
-        # deduplicate screenshots sent recently (avoid doubles)
-        global _LAST_SCREENSHOT_SEND
-        try:
-            _LAST_SCREENSHOT_SEND
-        except NameError:
-            _LAST_SCREENSHOT_SEND = {}
-
-        if screenshots:
-            # filter out screenshots sent in the last 30s
-            now_ts = time.time()
-            filtered = []
-            for p in screenshots:
-                last = _LAST_SCREENSHOT_SEND.get(p)
-                if last and now_ts - last < 30:
-                    continue
-                filtered.append(p)
-            screenshots = filtered
-            files = {}
-            multipart = {'payload_json': (None, json.dumps(payload))}
-            for i, path in enumerate(screenshots):
-                try:
-                    if not os.path.exists(path):
+        embeds = []
+        attachments = []
+        now_ts = time.time()
+        # fichiers joints fermés à la sortie du bloc, même si le POST lève une exception
+        with contextlib.ExitStack() as stack:
+            files_param = {}
+            for content in contents:
+                embed = _discord_embed(content)
+                shots = content.get('screenshots') if isinstance(content, dict) else None
+                for path in shots or ():
+                    # deduplicate screenshots sent recently (avoid doubles)
+                    last = _LAST_SCREENSHOT_SEND.get(path)
+                    if last and now_ts - last < 30:
                         continue
-                    key = f'file{i}'
-                    files[key] = (os.path.basename(path), open(path, 'rb'), mimetypes.guess_type(path)[0] or 'application/octet-stream')
-                except Exception:
-                    continue
-            # requests expects files as dict of name: (filename, fileobj, content_type)
-            files_payload = {k: v for k, v in files.items()}
-            # build files param merging payload_json
-            # Note: requests uses a tuple (name, filetuple)
-            files_param = {'payload_json': (None, json.dumps(payload))}
-            files_param.update({k: (v[0], v[1], v[2]) for k, v in files.items()})
-            r = requests.post(webhook, files=files_param, timeout=20)
-            # close opened file objects
-            try:
-                for v in files.values():
-                    try:
-                        v[1].close()
-                    except Exception:
-                        pass
-            except Exception:
-                pass
-            # mark sent
-            if r.status_code < 400:
-                for p in screenshots:
+                    # ouverture directe (EAFP): remplace le test os.path.exists préalable; sans buffer,
+                    # requests lit le fichier d'un bloc
                     try:
-                        _LAST_SCREENSHOT_SEND[p] = time.time()
-                    except Exception:
-                        pass
-        else:
-            r = requests.post(webhook, json=payload, timeout=10)
+                        fh = stack.enter_context(open(path, 'rb', buffering=0))
+                    except OSError:
+                        continue
+                    # préfixe d'index: noms uniques dans la requête
+                    fname = f"{len(attachments)}_{os.path.basename(path)}"
+                    files_param[f'file{len(attachments)}'] = (fname, fh, _attachment_mime(os.path.splitext(path)[1].lower()))
+                    attachments.append(path)
+                    embed.setdefault('image', {'url': f'attachment://{fname}'})
+                embeds.append(embed)
+            payload = {'embeds': embeds}
+
+            if attachments:
+                files_param = {'payload_json': (None, json.dumps(payload)), **files_param}
+                r = _http_session().post(webhook, files=files_param, timeout=20)
+            else:
+                r = _http_session().post(webhook, json=payload, timeout=10)
+
+        # mark sent
+        if attachments and r.status_code < 400:
+            for path in attachments:
+                _LAST_SCREENSHOT_SEND[path] = time.time()
 
         if r.status_code >= 400:
             log(f"Webhook error: {r.status_code} {r.text}", conf=conf)
     except Exception as e:
+        import traceback
         tb = traceback.format_exc()
         log(f"Erreur webhook: {e} {tb}", conf=conf)
 
 
+def _discord_worker(q):
+    while True:
+        contents, conf = q.get()
+        try:
+            _post_discord(contents, conf=conf)
+        finally:
+            q.task_done()
+
+
+def _discord_enqueue(contents, conf):
+    """Confie l'envoi au thread de fond (un seul: l'ordre des messages est conservé)."""
+    global _DISCORD_Q
+    if not contents or not (conf and conf.get('discord_webhook')):
+        return
+    with _DISCORD_Q_LOCK:
+        if _DISCORD_Q is None:
+            import queue
+            _DISCORD_Q = queue.Queue()
+            threading.Thread(target=_discord_worker, args=(_DISCORD_Q,), name='discord', daemon=True).start()
+            atexit.register(discord_drain)
+    _DISCORD_Q.put((contents, conf))
+
+
+def discord_drain():
+    """Attend la fin des envois webhook en attente (à appeler avant la sortie)."""
+    if _DISCORD_Q is not None:
+        _DISCORD_Q.join()
+
+
+class DiscordBatcher:
+    """Regroupe les notifications d'un service et les envoie en un minimum de requêtes webhook (en arrière-plan).
+
+    Vidé automatiquement avant de dépasser les limites Discord d'un message (10 embeds,
+    10 pièces jointes, 6000 caractères), et explicitement par flush().
+    """
+
+    def __init__(self, conf):
+        self.conf = conf
+        self.pending = []
+        self.size = 0
+        self.files = 0
+
+    def add(self, content):
+        size = _embed_size(_discord_embed(content))
+        files = len(content.get('screenshots') or ()) if isinstance(content, dict) else 0
+        if self.pending and (len(self.pending) >= DISCORD_MAX_EMBEDS or self.files + files > DISCORD_MAX_FILES
+                             or self.size + size > DISCORD_MAX_EMBED_CHARS):
+            self.flush()
+        self.pending.append(content)
+        self.size += size
+        self.files += files
+
+    def flush(self):
+        if not self.pending:
+            return
+        pending, self.pending, self.size, self.files = self.pending, [], 0, 0
+        _discord_enqueue(pending, self.conf)
+
+
+def _challenge_locator(page):
+    """En-tête visible de l'interstitiel (course d'attente après navigation)."""
+    return page.locator(CHALLENGE_SELECTOR).filter(has_text=CHALLENGE_TEXT_RE)
+
+
+def head_html(page, n=1200):
+    """Retourne les n premiers caractères du HTML sans sérialiser tout le DOM côté Python."""
+    try:
+        return page.evaluate(HEAD_PROBE_JS, n) or ''
+    except Exception:
+        return ''
+
+
+def is_security_challenge(page):
+    """Détecte un interstitiel de challenge (titre/en-tête + CHALLENGE_RE) en un seul aller-retour, sans rapatrier le DOM."""
+    try:
+        return bool(page.evaluate(CHALLENGE_PROBE_JS, [CHALLENGE_SELECTOR, CHALLENGE_TEXT_RE.pattern, CHALLENGE_RE.pattern]))
+    except Exception:
+        return False
+
+
 def save_cookies_output(cookies):
     # Affiche JSON sur stdout pour copie
     out = {c['name']: c['value'] for c in cookies}
     print(json.dumps({'cookies': out}, indent=2))
 
 
+def dry_fetch_cookies(conf):
+    """Mode --dry sans navigateur: GET de la page de gestion avec les cookies de la config.
+
+    Retourne False si la page exige l'exécution JS (challenge / 403), auquel cas il faut passer par Playwright.
+    """
+    import requests
+    manage_url = conf.get('service_manage_url')
+    http_conf = conf.get('http', {}) or {}
+    session = requests.Session()
+    if http_conf.get('user_agent'):
+        session.headers['User-Agent'] = http_conf['user_agent']
+    session.cookies.update({k: v for k, v in (conf.get('cookies', {}) or {}).items() if v})
+    try:
+        r = session.get(manage_url, timeout=http_conf.get('timeout') or 10)
+    except Exception as e:
+        log(f"Dry: requête HTTP impossible ({e}), passage par le navigateur.", conf=conf)
+        return False
+    if r.status_code in (403, 503) or CHALLENGE_RE.search(r.text or ''):
+        log(f"Dry: challenge détecté (HTTP {r.status_code}), passage par le navigateur.", conf=conf)
+        return False
+    print('Ouverture (HTTP):', manage_url)
+    print('URL finale:', r.url)
+    save_cookies_output([{'name': c.name, 'value': c.value} for c in session.cookies])
+    return True
+
+
 def _ensure_screens_dir():
     d = Path(__file__).parent / 'screenshots'
     try:
@@ -189,109 +598,464 @@ def _ensure_screens_dir():
     return d
 
 
-def capture_screenshot(page, label='screenshot'):
+def _storage_state_path(conf):
+    p = (conf.get('paths', {}) or {}).get('storage_state')
+    if p:
+        return Path(p)
+    return Path(__file__).parent / 'state.json'
+
+
+def save_storage_state(context, path, conf=None):
+    """Écrit la session dans un fichier temporaire puis le renomme (os.replace, atomique): des services
+    en parallèle sur le même `state.json` ne peuvent pas laisser un JSON tronqué."""
+    tmp = None
+    try:
+        state = context.storage_state()
+        fd, tmp = tempfile.mkstemp(prefix=path.name + '.', suffix='.tmp', dir=str(path.parent))
+        with os.fdopen(fd, 'w') as fh:
+            json.dump(state, fh)
+        os.replace(tmp, path)
+        log(f"Session sauvegardée: {path}", conf=conf)
+    except Exception as e:
+        log(f"Erreur sauvegarde session: {e}", conf=conf)
+        if tmp:
+            with contextlib.suppress(OSError):
+                os.unlink(tmp)
+
+
+def _last_run_path(conf):
+    p = (conf.get('paths', {}) or {}).get('last_run_file')
+    if p:
+        return Path(p)
+    return Path(__file__).parent / 'last_run.json'
+
+
+def _load_last_runs(conf):
+    """{manage_url: {'last_renew_ts': ts}} des derniers renouvellements réussis."""
+    try:
+        return _json_loads(_last_run_path(conf).read_bytes())
+    except Exception:
+        return {}
+
+
+def record_last_run(conf, manage_url):
+    # lecture-modification-écriture protégée: les services peuvent finir en parallèle (max_parallel)
+    with _LAST_RUN_LOCK:
+        runs = _load_last_runs(conf)
+        runs[manage_url] = {'last_renew_ts': time.time()}
+        try:
+            _last_run_path(conf).write_text(json.dumps(runs, indent=2))
+        except Exception as e:
+            log(f"Erreur écriture last_run: {e}", conf=conf)
+
+
+def renewed_recently(conf, manage_url, runs=None):
+    """Vrai si le dernier renouvellement date de moins de `min_days_between_runs` jours.
+
+    Le site refuse de toute façon le renouvellement trop tôt (Renewal Restricted): inutile de lancer le navigateur.
+    """
+    min_days = conf.get('min_days_between_runs') or 0
+    if min_days <= 0:
+        return False
+    if runs is None:
+        runs = _load_last_runs(conf)
+    last = (runs.get(manage_url) or {}).get('last_renew_ts')
+    return bool(last) and time.time() - last < min_days * 86400
+
+
+def capture_screenshot(page, label='screenshot', full_page=False):
+    """Capture JPEG de la zone visible (page entière en PNG avec full_page, cf. --full-screenshot)."""
     try:
         d = _ensure_screens_dir()
-        fname = f"{int(time.time())}_{label}.png"
-        path = d / fname
-        # capture full page to show entire content
-        page.screenshot(path=str(path), full_page=True)
+        if full_page:
+            path = d / f"{int(time.time())}_{label}.png"
+            page.screenshot(path=str(path), full_page=True)
+        else:
+            # viewport seul en JPEG: bien plus léger à encoder, écrire et envoyer au webhook
+            path = d / f"{int(time.time())}_{label}.jpg"
+            page.screenshot(path=str(path), type='jpeg', quality=SCREENSHOT_JPEG_QUALITY)
         return str(path)
     except Exception as e:
         log(f"Erreur screenshot: {e}")
         return None
 
 
-def debug_wait(step_name, debug=False, headful=False):
+def _install_debug_resume():
+    """Sources de reprise des pauses --debug: SIGUSR1 (`kill -USR1 <pid>`) et, si terminal, la touche Entrée."""
+    global _DEBUG_RESUME_SOURCES
+    if _DEBUG_RESUME_SOURCES is not None:
+        return _DEBUG_RESUME_SOURCES
+    sources = []
+    import signal
+    if hasattr(signal, 'SIGUSR1'):
+        try:
+            signal.signal(signal.SIGUSR1, lambda *_: _DEBUG_STEP.set())
+            sources.append(f'kill -USR1 {os.getpid()}')
+        except ValueError:
+            # signal.signal n'est possible que depuis le thread principal
+            pass
+    if sys.stdin and sys.stdin.isatty():
+        def _read_stdin():
+            while sys.stdin.readline():
+                _DEBUG_STEP.set()
+        threading.Thread(target=_read_stdin, daemon=True).start()
+        sources.append('Entrée')
+    _DEBUG_RESUME_SOURCES = sources
+    return sources
+
+
+def debug_wait(step_name, debug=False, headful=False, notify=None):
     if not debug:
         return
+    # notifications en attente envoyées avant la pause, pour les voir pendant l'inspection
+    if notify:
+        notify.flush()
     hint = ' (headful: vous pouvez interagir avec la page)' if headful else ''
+    sources = _install_debug_resume()
+    _DEBUG_STEP.clear()
+    if not sources:
+        # rien ne peut signaler la reprise: court délai comme avant
+        time.sleep(1)
+        return
+    log(f"DEBUG: étape '{step_name}'. {' ou '.join(sources)} pour continuer{hint}...")
+    if not _DEBUG_STEP.wait(timeout=DEBUG_WAIT_TIMEOUT):
+        log(f"DEBUG: pas de reprise après {DEBUG_WAIT_TIMEOUT}s, on continue.")
+
+
+def detect_invoice_amount(page, snippet=''):
+    """Montant brut de la facture affichée et méthode l'ayant trouvé: ('0,00 €', 'totals').
+
+    Toute la recherche s'exécute dans la page (AMOUNT_DETECT_JS, arrêt à la première méthode qui
+    donne un montant): seul le résultat traverse CDP. L'extrait HTML `snippet` sert de dernier recours.
+    """
     try:
-        input(f"DEBUG: étape '{step_name}'. Appuyez sur Entrée pour continuer{hint}...")
+        res = page.evaluate(AMOUNT_DETECT_JS, [TOTALS_ROW_SELECTOR, list(AMOUNT_SELECTORS)]) or {}
+        if res.get('amount'):
+            return res['amount'], res.get('how')
     except Exception:
-        # si non interactif, fallback à un court délai
-        time.sleep(1)
+        pass
+    m = SNIPPET_AMOUNT_EUR_RE.search(snippet) or SNIPPET_AMOUNT_RE.search(snippet)
+    if m:
+        return m.group(0), 'snippet'
+    return '', None
+
+
+def parse_amount(s):
+    """Montant brut ('1 234,56 €') -> float, None si illisible."""
+    if not s:
+        return None
+    m = NUM_RE.search(s.translate(AMOUNT_TRANSLATE))
+    return float(m.group(0)) if m else None
+
+
+def _blocked_resource_types(conf):
+    """`block_resources`: true (défaut) -> BLOCKED_RESOURCE_TYPES, false -> rien, liste -> types choisis."""
+    opt = conf.get('block_resources', True)
+    if opt is True:
+        return frozenset(BLOCKED_RESOURCE_TYPES)
+    if not opt:
+        return frozenset()
+    return frozenset(opt)
+
+
+def _resource_filter(conf):
+    """Handler context.route qui abandonne les types bloqués et les traqueurs (`blocked_hosts`), ou None."""
+    types = _blocked_resource_types(conf)
+    hosts = tuple(conf.get('blocked_hosts', BLOCKED_HOSTS) or ())
+    if not types and not hosts:
+        return None
+
+    def handler(route):
+        req = route.request
+        if req.resource_type in types:
+            return route.abort()
+        if hosts:
+            host = urlsplit(req.url).hostname or ''
+            if any(host == h or host.endswith('.' + h) for h in hosts):
+                return route.abort()
+        return route.continue_()
+    return handler
+
+
+def _chromium_args(conf):
+    # `chromium_args` permet d'ajouter des flags à CHROMIUM_ARGS
+    return [*CHROMIUM_ARGS, *(conf.get('chromium_args') or [])]
+
+
+def _cdp_alive(endpoint):
+    import urllib.request
+    try:
+        with urllib.request.urlopen(endpoint.rstrip('/') + '/json/version', timeout=2) as r:
+            return r.status == 200
+    except Exception:
+        return False
+
+
+def get_or_spawn_cdp_endpoint(p, conf):
+    """Retourne l'endpoint du Chromium démon (`cdp_daemon`), en le lançant s'il ne répond plus.
+
+    L'endpoint est mémorisé dans `paths.cdp_state_file`: les exécutions suivantes s'y reconnectent sans relancer Chromium.
+    """
+    # un seul worker à la fois peut lancer le démon (les autres réutilisent son endpoint)
+    with _CDP_SPAWN_LOCK:
+        return _get_or_spawn_cdp_endpoint(p, conf)
+
 
+def _cdp_state_path(conf):
+    # à côté du script (comme state.json), jamais dans le /tmp partagé: un autre utilisateur pourrait
+    # y désigner son propre navigateur, qui recevrait alors la session HidenCloud
+    p = (conf.get('paths', {}) or {}).get('cdp_state_file')
+    if p:
+        return Path(p)
+    return Path(__file__).parent / 'cdp.json'
 
-def _extract_amount_from_totals(page):
-    """Tente d'extraire le montant en ciblant les blocs 'Sous-total / Total' décrits par l'utilisateur."""
+
+def _chromium_profile_path(conf):
+    p = (conf.get('paths', {}) or {}).get('chromium_profile')
+    if p:
+        return Path(p)
+    return Path(__file__).parent / 'chromium-profile'
+
+
+def _get_or_spawn_cdp_endpoint(p, conf):
+    state_file = _cdp_state_path(conf)
+    try:
+        endpoint = _json_loads(state_file.read_bytes()).get('endpoint')
+        if endpoint and _cdp_alive(endpoint):
+            return endpoint
+    except Exception:
+        pass
+
+    endpoint, proc = _spawn_chromium(p, conf, _chromium_profile_path(conf))
+    state_file.write_text(json.dumps({'endpoint': endpoint, 'pid': proc.pid}))
+    print('Chromium démon lancé:', endpoint)
+    return endpoint
+
+
+def _spawn_chromium(p, conf, profile):
+    """Lance un Chromium headless exposant CDP sur un port libre; retourne (endpoint, process)."""
+    import subprocess
+    profile = Path(profile)
+    # profil privé (cookies de session): créé en 0700, refusé s'il appartient à un autre utilisateur
+    profile.mkdir(mode=0o700, parents=True, exist_ok=True)
+    if hasattr(os, 'getuid') and profile.stat().st_uid != os.getuid():
+        raise RuntimeError(f"profil Chromium {profile} appartenant à un autre utilisateur")
+    # Chromium écrit le port choisi (--remote-debugging-port=0) dans DevToolsActivePort
+    port_file = profile / 'DevToolsActivePort'
     try:
-        # Chercher des lignes structurées: .space-y-3 .flex.justify-between -> label / value
+        port_file.unlink()
+    except FileNotFoundError:
+        pass
+    exe = conf.get('chromium_path') or p.chromium.executable_path
+    proc = subprocess.Popen(
+        [exe, '--headless=new', '--remote-debugging-port=0', f'--user-data-dir={profile}', *_chromium_args(conf)],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True,
+    )
+    deadline = time.time() + 15
+    while time.time() < deadline:
         try:
-            nodes = page.query_selector_all('.space-y-3 .flex.justify-between')
-            for n in nodes:
-                try:
-                    parts = n.query_selector_all('div')
-                    if len(parts) >= 2:
-                        label = (parts[0].text_content() or '').strip().lower()
-                        value = (parts[1].text_content() or '').strip()
-                        if 'total' in label or 'sous-total' in label or 'sous total' in label or 'total' in label:
-                            return value
-                except Exception:
-                    continue
-        except Exception:
+            port = port_file.read_text().splitlines()[0].strip()
+            if port:
+                return f'http://127.0.0.1:{port}', proc
+        except (FileNotFoundError, IndexError):
             pass
+        time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError('Chromium: DevToolsActivePort introuvable')
+
 
-        # fallback: rechercher un élément contenant 'Total' puis récupérer son sibling
+def get_browser(p, conf, headful=False):
+    """Retourne (browser, via_cdp).
+
+    Si un endpoint CDP est configuré (`cdp_endpoint` dans config.json ou variable HIDEN_CDP_URL),
+    on se connecte au Chromium déjà lancé pour éviter le démarrage à froid. Avec `cdp_daemon`,
+    le script lance lui-même ce Chromium persistant au premier run. Sinon on lance Chromium.
+    """
+    endpoint = os.environ.get('HIDEN_CDP_URL') or conf.get('cdp_endpoint')
+    if not endpoint and conf.get('cdp_daemon'):
         try:
-            el = page.query_selector("text=/Total|Sous-total|Sous total|Sous-total/i")
-            if el:
-                val = page.evaluate("el => { let s = el.nextElementSibling || el.parentElement.querySelector('div:last-child'); return s ? s.textContent : null}", el)
-                if val:
-                    return val.strip()
-        except Exception:
-            pass
+            endpoint = get_or_spawn_cdp_endpoint(p, conf)
+        except Exception as e:
+            print('Chromium démon indisponible:', e)
+    if endpoint:
+        try:
+            browser = p.chromium.connect_over_cdp(endpoint)
+            print('Connecté au Chromium partagé (CDP):', endpoint)
+            return browser, True
+        except Exception as e:
+            print('Connexion CDP impossible, lancement local:', e)
+    browser = p.chromium.launch(headless=(not headful), args=_chromium_args(conf), ignore_default_args=['--enable-automation'])
+    return browser, False
+
+
+def _iter_services(conf):
+    """Une config par service: chaque entrée de `services` surcharge les clés globales de config.json.
+
+    `paths` est fusionné clé par clé: un service qui ne fixe que son `storage_state` garde le
+    `last_run_file` (et les autres chemins) de la config globale.
+    """
+    for svc in conf.get('services') or [{}]:
+        svc = svc or {}
+        svc_conf = dict(conf)
+        svc_conf.update(svc)
+        if 'paths' in svc:
+            svc_conf['paths'] = dict(conf.get('paths') or {}, **(svc['paths'] or {}))
+        yield svc_conf
 
-        # last resort: chercher le mot 'Total' dans le HTML et extraire le montant proche
+
+def detect_renewal_restricted(pg, watch=False, prefer_modal=False):
+    """(trouvé, raison) pour un message 'Renewal Restricted' affiché par la page.
+
+    Toute la détection s'exécute dans la page: le texte du body ne traverse pas CDP. Avec `watch`,
+    les mutations du DOM sont comptées ensuite (voir RESTRICTION_CHANGED_JS). Avec `prefer_modal`,
+    les conteneurs de messages sont examinés avant le texte du body.
+    """
+    def _detect():
+        # détecteur préinstallé (RESTRICTION_INSTALL_JS), sinon envoi du script complet
+        res = pg.evaluate(RESTRICTION_CALL_JS, [watch, prefer_modal])
+        if res is None:
+            res = pg.evaluate(RESTRICTION_DETECT_JS, [RESTRICTED_RE.pattern, RESTRICTION_SCAN_SELECTOR, list(RESTRICTION_SELECTORS), watch, prefer_modal])
+        return res
+    try:
+        res = _detect()
+    except Exception:
+        # contexte détruit par une navigation en cours: une seule nouvelle tentative une fois le
+        # document parsé (jamais de repli sur page.content(), qui sérialiserait tout le DOM)
         try:
-            html = page.content() or ''
-            import re
-            m = re.search(r"(Total|Sous-total|Sous total)[\s\S]{0,60}?(€?\s?\d[0-9\s\.,]*\d)", html, re.I)
-            if m:
-                return m.group(2).strip()
+            pg.wait_for_load_state('domcontentloaded', timeout=5000)
+            res = _detect()
         except Exception:
-            pass
+            return False, None
+    return bool(res.get('found')), res.get('why')
+
+
+def _is_step_response(response, host=None):
+    """Réponse déclenchée par le click d'une étape: POST (XHR ou formulaire) ou navigation du document
+    principal, réussie (2xx) et servie par l'hôte du site (pas de beacon tiers ni de sous-frame)."""
+    if not response.ok or urlsplit(response.url).hostname != host:
+        return False
+    req = response.request
+    if req.frame.parent_frame is not None:
+        return False
+    return req.method == 'POST' or req.is_navigation_request()
+
+
+def _click_step(page, name, selector, loc, timeout, conf=None, notify=None):
+    """Clique l'élément d'une étape: locator, puis heuristiques (FALLBACK_SCAN_JS). False si rien n'a été cliqué."""
+    # chemin rapide: attente (visible + actionnable) et click en un seul appel au driver,
+    # au lieu de wait_for + element_handle + click
+    try:
+        loc.click(timeout=timeout)
+        return True
     except Exception:
         pass
-    return None
+    # fallback: élément présent mais pas (encore) visible / cliquable
+    try:
+        el = loc.element_handle(timeout=500)
+    except Exception:
+        el = None
+    # fallback supplémentaires si élément pas trouvé: toutes les heuristiques
+    # sont évaluées dans la page en un seul aller-retour (élément marqué puis récupéré)
+    if not el:
+        try:
+            scan = page.evaluate(FALLBACK_SCAN_JS, list(FALLBACK_SELECTORS))
+        except Exception:
+            scan = {'found': False, 'snippet': None}
+        if not scan.get('found'):
+            # dernier recours : logguer un extrait autour du mot 'renouvel'
+            if scan.get('snippet') is not None:
+                log(f"Élément '{name}' introuvable mais le mot 'renouvel' apparaît dans la page. Extrait: {scan['snippet']}", conf=conf)
+            else:
+                log(f"Élément '{name}' introuvable avec le sélecteur/heuristique.", conf=conf)
+                if notify:
+                    notify.add({'title': "Renouvellement: élément introuvable", 'description': f"'{name}' introuvable (sélecteur: {selector})", 'status': 'warning', 'url': page.url})
+            return False
+        print(f"Élément '{name}' trouvé par heuristique: {scan.get('matched')}")
+        # locator sur l'élément marqué: pas d'ElementHandle à créer ni d'aller-retour dédié
+        el = page.locator('[data-hc-fallback]').first
+    # click sur l'élément trouvé par les heuristiques
+    try:
+        el.click(timeout=timeout)
+    except Exception:
+        # parfois click() échoue si l'élément est un <button type=submit>; utiliser evaluate
+        try:
+            el.evaluate("el => el.click()")
+        except Exception as e:
+            print(f"Impossible de cliquer sur '{name}': {e}")
+            return False
+    return True
 
 
-def main(run_renew=False, headful=False, timeout_ms=60000, use_config_cookies=True, bypass_restriction=False, confirm_pay=False, screen=False, debug=False):
-    conf = load_config()
+def _step_locators(page, sel_conf):
+    """[(nom, sélecteur affiché, locator)] des étapes renew -> create_invoice -> pay (sélecteur configuré ou regex précompilée).
+
+    Les locators couvrent toutes les correspondances: le filtre `visible=true` puis `.first` sont
+    appliqués à l'usage (click et attentes).
+    """
+    seq = []
+    for name in ('renew', 'create_invoice', 'pay'):
+        selector = sel_conf.get(name) or f"text=/{STEP_TEXT_RE[name].pattern}/i"
+        if sel_conf.get(name):
+            # sélecteur configuré seul: une union le mettrait en concurrence (ordre du DOM) avec les heuristiques
+            loc = page.locator(sel_conf[name])
+        else:
+            loc = page.get_by_text(STEP_TEXT_RE[name])
+            if name == 'renew':
+                # déclencheurs du modal de renouvellement dans la même union: un seul appel au driver
+                loc = loc.or_(page.locator(', '.join(FALLBACK_SELECTORS)))
+        seq.append((name, selector, loc))
+    return seq
+
+
+def process_service(browser, conf, run_renew=False, headful=False, timeout_ms=60000, use_config_cookies=True, bypass_restriction=False, confirm_pay=False, screen=False, debug=False, full_screenshot=False, notify=None):
+    """Traite un service dans son propre contexte (cookies isolés) sur le navigateur partagé.
+
+    Les notifications Discord passent par `notify` (DiscordBatcher), vidé par l'appelant; à défaut
+    un batcher local est créé et vidé en fin de traitement.
+    """
+    own_notify = notify is None
+    if own_notify:
+        notify = DiscordBatcher(conf)
     manage_url = conf.get('service_manage_url')
     base = conf.get('base_url')
-    if not manage_url:
-        print('Erreur: service_manage_url manquant dans config.json')
-        return 2
+    # sous-sections de config lues une seule fois
+    sel_conf = conf.get('selectors') or {}
+    http_conf = conf.get('http') or {}
 
-    with sync_playwright() as p:
-        browser = p.chromium.launch(headless=(not headful), args=["--no-sandbox", "--disable-blink-features=AutomationControlled"])
-        # set a user agent if present in config
-        ua = None
-        try:
-            ua = conf.get('http', {}).get('user_agent')
-        except Exception:
-            ua = None
-        context_kwargs = {}
-        if ua:
-            context_kwargs['user_agent'] = ua
-        context = browser.new_context(**context_kwargs)
+    # set a user agent if present in config
+    ua = http_conf.get('user_agent')
+    context_kwargs = {}
+    if ua:
+        context_kwargs['user_agent'] = ua
+    # restaurer la session précédente (cookies + localStorage) en un seul appel si disponible
+    state_path = _storage_state_path(conf)
+    has_state = state_path.exists()
+    if has_state:
+        context_kwargs['storage_state'] = str(state_path)
+        print('Session restaurée depuis:', state_path)
+    context = browser.new_context(**context_kwargs)
+    # contexte fermé même sur exception: avec cdp_endpoint/cdp_daemon le navigateur n'est jamais
+    # fermé et garderait le contexte et sa page ouverts d'un run à l'autre
+    try:
+        route_filter = _resource_filter(conf)
+        if route_filter:
+            context.route('**/*', route_filter)
+        if run_renew:
+            # détecteur 'Renewal Restricted' présent dans chaque document dès sa création
+            context.add_init_script(script=RESTRICTION_INSTALL_JS)
         page = context.new_page()
+        # locators des étapes construits une seule fois (ils sont paresseux: utilisables avant la navigation)
+        seq = _step_locators(page, sel_conf) if run_renew else []
+        # --screen: une seule capture de l'état final (résumé); les captures intermédiaires seulement avec --debug
+        step_shots = screen and debug
 
-        # inject cookies from config before navigation (always enabled by default)
-        if use_config_cookies:
+        # inject cookies from config before navigation (bootstrap: uniquement sans session sauvegardée)
+        if use_config_cookies and not has_state:
             try:
                 conf_cookies = conf.get('cookies', {}) or {}
-                cookie_list = []
-                for name, val in conf_cookies.items():
-                    if not val:
-                        continue
-                    # domain must be provided for playwright cookie; derive from base if available
-                    domain = None
-                    if base:
-                        # remove scheme
-                        domain = base.replace('https://', '').replace('http://', '').split('/')[0]
-                    cookie_list.append({'name': name, 'value': val, 'domain': domain, 'path': '/'})
+                # domain must be provided for playwright cookie; derive it once from base (or the manage URL)
+                domain = urlsplit(base or manage_url).hostname
+                cookie_list = [{'name': n, 'value': v, 'domain': domain, 'path': '/'} for n, v in conf_cookies.items() if v]
                 if cookie_list:
                     context.add_cookies(cookie_list)
                     print('Cookies injectés dans le contexte (names):', [c['name'] for c in cookie_list])
@@ -300,35 +1064,45 @@ def main(run_renew=False, headful=False, timeout_ms=60000, use_config_cookies=Tr
 
         print('Ouverture:', manage_url)
         try:
-            # tente un goto rapide sur domcontentloaded puis attend networkidle si possible
-            page.goto(manage_url, timeout=timeout_ms, wait_until='domcontentloaded')
-            # si bypass_restriction, réduire l'attente pour aller plus vite
-            try:
-                if bypass_restriction:
-                    page.wait_for_load_state('load', timeout=min(5000, timeout_ms))
-                else:
-                    page.wait_for_load_state('networkidle', timeout=min(timeout_ms, 60000))
-            except Exception:
-                # fallback: wait un court temps
-                page.wait_for_timeout(1000 if bypass_restriction else 2000)
+            # goto rend la main dès la réponse reçue ('commit'); pas d'attente networkidle (jamais atteint
+            # avec analytics/polling): on attend directement ce dont la suite a besoin
+            page.goto(manage_url, timeout=timeout_ms, wait_until='commit')
+            if run_renew:
+                # premier arrivé: bouton Renouveler visible (page prête), challenge (abandon juste après) ou
+                # message de restriction (page sans bouton: inutile d'attendre timeout_ms)
+                try:
+                    # chaque branche filtrée sur les éléments visibles: `.first` suit l'ordre du DOM, un
+                    # nœud caché placé avant (ex: texte du modal de renouvellement) bloquerait l'attente
+                    ready = seq[0][2].locator('visible=true').or_(_challenge_locator(page).locator('visible=true')).or_(page.get_by_text(RESTRICTED_RE).locator('visible=true'))
+                    ready.first.wait_for(state='visible', timeout=timeout_ms)
+                except Exception as e:
+                    print('Bouton renouveler non visible après chargement:', e)
+            else:
+                # export des cookies / session: attendre 'load' (scripts exécutés, cookies posés par JS
+                # comme le rafraîchissement turnstile/clearance), toujours sans networkidle
+                page.wait_for_load_state('load', timeout=timeout_ms)
             # capture après chargement
-            if screen:
-                pth = capture_screenshot(page, 'loaded')
+            # sans run-renew, la page chargée est l'état final
+            if step_shots or (screen and not run_renew):
+                pth = capture_screenshot(page, 'loaded', full_page=full_screenshot)
                 if pth:
-                    send_discord({'title': 'Page chargée', 'description': 'Page ouverte', 'status': 'info', 'url': page.url, 'screenshots': [pth]}, conf=conf)
-            debug_wait('after_goto', debug=debug, headful=headful)
+                    notify.add({'title': 'Page chargée', 'description': 'Page ouverte', 'status': 'info', 'url': page.url, 'screenshots': [pth]})
+            debug_wait('after_goto', debug=debug, headful=headful, notify=notify)
         except Exception as e:
             print('Navigation erreur / timeout:', e)
 
         # si la page affiche un challenge, on capture le titre
-        title = page.title()
+        try:
+            title = page.title()
+        except Exception:
+            # après goto('commit'), le document peut encore être remplacé (contexte d'exécution détruit)
+            title = ''
         url = page.url
-        content_snippet = page.content()[:2000]
         print('Titre:', title)
         print('URL finale:', url)
 
-        # extraire cookies
-        cookies = context.cookies()
+        # extraire les cookies du seul domaine HidenCloud (pas ceux des analytics/CDN)
+        cookies = context.cookies([base or manage_url])
         save_cookies_output(cookies)
 
         # si on execute l'option run_renew, tenter d'appuyer sur Renouveler -> Créer une facture -> Payer
@@ -339,397 +1113,309 @@ def main(run_renew=False, headful=False, timeout_ms=60000, use_config_cookies=Tr
                 amt_val = None
 
                 # vérifier si la page affiche un challenge qui bloquerait (ex: Security Verification)
-                page_html = page.content().lower()
-                if 'security verification' in page_html or 'cf_chl_prog' in page_html or 'turnstile' in page_html:
+                if is_security_challenge(page):
                     log('La page semble afficher un challenge de sécurité (403/JS). Abandon de run-renew.', conf=conf)
-                    send_discord({'title': 'Renouvellement: challenge', 'description': 'La page affiche un challenge de sécurité (403/JS). Intervention requise.', 'status': 'failure', 'url': page.url}, conf=conf)
+                    notify.add({'title': 'Renouvellement: challenge', 'description': 'La page affiche un challenge de sécurité (403/JS). Intervention requise.', 'status': 'failure', 'url': page.url})
                     renew_status.update({'status': 'failed', 'reason': 'security_challenge'})
                 else:
-                    sel_conf = conf.get('selectors', {}) or {}
-                    seq = [
-                        ('renew', sel_conf.get('renew') or 'text=/Renouvel|renouvel|Renew/i'),
-                        ('create_invoice', sel_conf.get('create_invoice') or 'text=/Créer une facture|Create Invoice/i'),
-                        ('pay', sel_conf.get('pay') or 'text=/Payer|Pay/i'),
-                    ]
+                    markers = dict(STEP_MARKERS, **(conf.get('markers', {}) or {}))
                     selector_timeout_default = 5000
                     selector_timeout_bypass = 2000
-                    for name, selector in seq:
+                    for i, (name, selector, matches) in enumerate(seq):
+                        # premier élément visible: une correspondance cachée placée avant dans le DOM (ex: toggle
+                        # de fermeture du modal de renouvellement) ne doit ni bloquer ni recevoir le click
+                        loc = matches.locator('visible=true').first
                         try:
                             print(f"Tentative click '{name}' avec sélecteur: {selector}")
-                            # attendre la présence de l'élément (timeout réduit)
-                            el = None
                             to = selector_timeout_bypass if bypass_restriction else selector_timeout_default
-                            try:
-                                el = page.wait_for_selector(selector, timeout=to)
-                            except Exception:
-                                # fallback: query_selector sans attendre
-                                try:
-                                    el = page.query_selector(selector)
-                                except Exception:
-                                    el = None
-                            # debug pause before interacting
-                            debug_wait(f'before_click:{name}', debug=debug, headful=headful)
-                            # fallback supplémentaires si élément pas trouvé
-                            if not el:
-                                # essayer une recherche par texte (différentes variantes)
-                                try:
-                                    txt_sel = "text=Renouveler"
-                                    el = page.query_selector(txt_sel)
-                                except Exception:
-                                    el = None
-                            if not el:
-                                try:
-                                    el = page.query_selector("text=/renouvel/i")
-                                except Exception:
-                                    el = None
-                            if not el:
-                                # essayer button:has-text
-                                try:
-                                    el = page.query_selector("button:has-text(\"Renouveler\")")
-                                except Exception:
-                                    el = None
-                            if not el:
-                                # essayer attributs data-modal-target/toggle partiel
-                                try:
-                                    el = page.query_selector("[data-modal-target*=\"renewService\"], [data-modal-toggle*=\"renewService\"]")
-                                except Exception:
-                                    el = None
-                            if not el:
-                                # dernier recours : inspecter un extrait du DOM pour occurrences du mot et logguer
-                                try:
-                                    # limiter la taille lue pour aller plus vite en bypass
+                            # message 'Renewal Restricted' déjà affiché: vérifié AVANT le click renew (sans bypass,
+                            # ni click ni attente de l'étape suivante)
+                            if name == 'renew':
+                                # watch: le DOM est surveillé jusqu'au contrôle d'après click
+                                pre_found, pre_why = detect_renewal_restricted(page, watch=True)
+                                if pre_found:
+                                    log('Renewal Restricted détecté AVANT click renew (' + (pre_why or '') + ').', conf=conf)
+                                    notify.add({'title': 'Renouvellement restreint', 'description': 'Renewal Restricted détecté avant tentative.', 'status': 'failure', 'url': page.url, 'reason': pre_why})
+                                    renew_status.update({'status': 'failed', 'reason': f'renewal_restricted_before:{pre_why}'})
                                     if bypass_restriction:
-                                        body_text = (page.content() or '')[:4000]
+                                        log('Bypass demandé: on poursuit malgré la restriction (dangerous).', conf=conf)
+                                        notify.add({'title': 'Renouvellement: bypass', 'description': 'Proceeding despite Renewal Restricted due to --bypass-restriction flag. Attention.', 'status': 'warning', 'url': page.url})
                                     else:
-                                        body_text = page.inner_text('body')
-                                except Exception:
-                                    body_text = (page.content() or '')[:2000]
-                                # log excerpt around 'renouvel'
-                                if 'renouvel' in body_text.lower() or 'renew' in body_text.lower():
-                                    snippet = ''
-                                    low = body_text.lower()
-                                    idx = low.find('renouvel')
-                                    if idx == -1:
-                                        idx = low.find('renew')
-                                    if idx >= 0:
-                                        start = max(0, idx - 120)
-                                        snippet = body_text[start:start+400]
-                                    log(f"Élément '{name}' introuvable mais le mot 'renouvel' apparaît dans la page. Extrait: {snippet}", conf=conf)
-                                else:
-                                    log(f"Élément '{name}' introuvable avec le sélecteur/heuristique.", conf=conf)
-                                    send_discord({'title': f"Renouvellement: élément introuvable", 'description': f"'{name}' introuvable (sélecteur: {selector})", 'status': 'warning', 'url': page.url}, conf=conf)
-                                continue
-                            # click et attendre réseau / petit délai
-                            try:
-                                el.click()
-                            except Exception:
-                                # parfois click() échoue si l'élément est un <button type=submit>; utiliser evaluate
+                                        break
+                            # debug pause before interacting
+                            debug_wait(f'before_click:{name}', debug=debug, headful=headful, notify=notify)
+                            to_next = 5000 if bypass_restriction else 8000
+                            step_response = None
+                            if i + 1 == len(seq) and not markers.get(name):
+                                # dernière étape sans marqueur: sa fin est la réponse que déclenche le click (POST
+                                # ou navigation du document principal, même hôte, 2xx); seul le click est encadré
+                                # par expect_response, retiré en sortie du bloc quel que soit le chemin
+                                host = urlsplit(page.url).hostname
+                                clicked = False
                                 try:
-                                    page.evaluate("el => el.click()", el)
+                                    with page.expect_response(functools.partial(_is_step_response, host=host), timeout=to + to_next) as resp_info:
+                                        clicked = _click_step(page, name, selector, loc, to, conf=conf, notify=notify)
+                                        if not clicked:
+                                            # exception: annule l'attente de la réponse (rien n'a été cliqué)
+                                            raise RuntimeError(f"'{name}' non cliqué")
+                                    step_response = resp_info.value
                                 except Exception as e:
-                                    print(f"Impossible de cliquer sur '{name}': {e}")
+                                    if clicked:
+                                        log(f"Aucune réponse du site après le click '{name}': {e}", conf=conf)
+                                if not clicked:
+                                    continue
+                            else:
+                                if not _click_step(page, name, selector, loc, to, conf=conf, notify=notify):
                                     continue
-                            # attendre navigation ou réseau bref (plus court si bypass)
-                            try:
-                                if bypass_restriction:
-                                    page.wait_for_load_state('load', timeout=5000)
-                                else:
-                                    page.wait_for_load_state('networkidle', timeout=8000)
-                            except Exception:
-                                page.wait_for_timeout(800 if bypass_restriction else 1200)
+                                # attendre le marqueur de l'étape (par défaut le bouton suivant) plutôt que
+                                # networkidle, qui attend souvent le timeout complet
+                                try:
+                                    if markers.get(name):
+                                        page.locator(markers[name]).locator('visible=true').first.wait_for(state='visible', timeout=to_next)
+                                    elif i + 1 < len(seq):
+                                        seq[i + 1][2].locator('visible=true').first.wait_for(state='visible', timeout=to_next)
+                                except Exception:
+                                    # dernier recours: attendre un signal DOM réel (page interactive) plutôt qu'un délai fixe
+                                    try:
+                                        page.wait_for_function(PAGE_READY_JS, timeout=2000)
+                                    except Exception:
+                                        pass
                             log(f"Après click '{name}', URL: {page.url}", conf=conf)
                             # dump court pour debug
-                            snippet = (page.content() or '')[:1200]
-                            log(f"Snippet après '{name}': {snippet[:800]}", conf=conf)
+                            snippet = head_html(page, 1200)
+                            log(f"Snippet après '{name}': {snippet}", conf=conf)
                             # capture écran après click si demandé
-                            if screen:
-                                pth = capture_screenshot(page, name)
+                            if step_shots:
+                                pth = capture_screenshot(page, name, full_page=full_screenshot)
                                 if pth:
-                                    send_discord({'title': f"Étape {name}", 'description': f"Étape {name} effectuée", 'status': 'info', 'url': page.url, 'screenshots': [pth]}, conf=conf)
-                            debug_wait(f'after_click:{name}', debug=debug, headful=headful)
+                                    notify.add({'title': f"Étape {name}", 'description': f"Étape {name} effectuée", 'status': 'info', 'url': page.url, 'screenshots': [pth]})
+                            debug_wait(f'after_click:{name}', debug=debug, headful=headful, notify=notify)
                             # si on vient de cliquer sur 'pay', considérer le workflow comme réussi
                             if name == 'pay':
-                                renew_status.update({'status': 'success', 'reason': 'paid', 'url': page.url})
-                                try:
-                                    extras = {'title': 'Paiement déclenché', 'description': 'Bouton Payer cliqué', 'status': 'success', 'url': page.url}
-                                    if screen:
-                                        p = capture_screenshot(page, 'paid')
-                                        if p:
-                                            extras['screenshots'] = [p]
-                                    send_discord(extras, conf=conf)
-                                except Exception:
-                                    pass
+                                # sans réponse du site dans le délai, le paiement n'est pas confirmé
+                                reason = 'paid' if step_response is not None or markers.get(name) else 'paid_unconfirmed'
+                                renew_status.update({'status': 'success', 'reason': reason, 'url': page.url})
+                                notify.add({'title': 'Paiement déclenché', 'description': 'Bouton Payer cliqué', 'status': 'success', 'url': page.url})
                                 break
                             # Si on vient de créer une facture, extraire le montant et décider du paiement
                             if name == 'create_invoice':
-                                # tenter d'extraire un montant (0.00, 0,00, €)
-                                amt_text = ''
-                                # tentative ciblée sur la structure 'Sous-total / Total' (plus fiable)
-                                try:
-                                    found = _extract_amount_from_totals(page)
-                                    if found:
-                                        amt_text = found
-                                except Exception:
-                                    pass
-                                try:
-                                    # chercher éléments usuels sur la page facture
-                                    # ex: .invoice-amount, .amount, .price, .total, strong
-                                    import re
-                                    # prefer explicit amount containers before generic tags like <strong>
-                                    for sel_amt in ['.invoice-amount', '.amount', '.price', '.total', 'strong']:
-                                        try:
-                                            node_amt = page.query_selector(sel_amt)
-                                            if node_amt:
-                                                candidate = (node_amt.text_content() or '').strip()
-                                                # n'accepter que si on trouve au moins un chiffre ou un symbole monétaire
-                                                if not candidate:
-                                                    continue
-                                                if re.search(r"\d", candidate) or '€' in candidate or '$' in candidate or '£' in candidate:
-                                                    amt_text = candidate
-                                                    break
-                                                # sinon ignorer (ex: titre de la page comme 'HidenCloud™')
-                                        except Exception:
-                                            pass
-                                except Exception:
-                                    pass
-                                # fallback: recherche plus robuste dans tout le HTML
-                                if not amt_text:
-                                    try:
-                                        import re
-                                        page_full = page.content() or ''
-                                        low = page_full.lower()
-                                        # priorité: mentions explicites de gratuité
-                                        if re.search(r"\b(gratuit|gratuitement|free|no charge|without charge)\b", low, re.I):
-                                            amt_text = '0.00'
-                                        else:
-                                            # collecter candidats monétaires : formats type 123.45 ou 1 234,56 ou avec symbole € $ £
-                                            candidates = []
-                                            # pattern qui capture nombre + optional currency symbol
-                                            pat = re.compile(r"(?P<num>\d{1,3}(?:[\d\s\.\,]*\d)?[\.,]\d{2})\s*(?P<cur>€|eur|\$|usd|£|gbp)?", re.I)
-                                            for m in pat.finditer(page_full):
-                                                idx = m.start()
-                                                txt = m.group(0).strip()
-                                                candidates.append((idx, txt))
-
-                                            # pattern with explicit symbol before amount (e.g. € 12.34)
-                                            pat2 = re.compile(r"(?P<cur>€|\$|£)\s*(?P<num>\d+[\.,]\d{2})", re.I)
-                                            for m in pat2.finditer(page_full):
-                                                idx = m.start()
-                                                txt = m.group(0).strip()
-                                                candidates.append((idx, txt))
-
-                                            # si on a des candidats, choisir celui proche d'un label utile
-                                            chosen = None
-                                            if candidates:
-                                                # labels utiles
-                                                labels = ['total', 'montant', 'price', 'amount', 'due', 'subtotal', 'balance', 'prix']
-                                                best_score = None
-                                                for idx, txt in candidates:
-                                                    score = 999999
-                                                    # cherche label proximité +/- 120 chars
-                                                    window_start = max(0, idx - 120)
-                                                    window_end = idx + 120
-                                                    context = page_full[window_start:window_end].lower()
-                                                    for lab in labels:
-                                                        pos = context.find(lab)
-                                                        if pos != -1:
-                                                            # distance to center
-                                                            dist = abs((window_start + pos) - idx)
-                                                            if dist < score:
-                                                                score = dist
-                                                    # si aucun label trouvé, use default large score
-                                                    if best_score is None or score < best_score:
-                                                        best_score = score
-                                                        chosen = txt
-                                                amt_text = chosen
-                                            else:
-                                                # dernier recours: chercher motifs simples dans snippet
-                                                m = re.search(r"(0[,.]0{1,2}|\d+[,.]\d{2})\s*€", snippet)
-                                                if m:
-                                                    amt_text = m.group(0)
-                                                else:
-                                                    m2 = re.search(r"(0[,.]0{1,2}|\d+[,.]\d{2})", snippet)
-                                                    if m2:
-                                                        amt_text = m2.group(0)
-                                    except Exception:
-                                        # si tout échoue, ne pas crash
-                                        amt_text = ''
-                                log(f"Montant détecté facture (raw): '{amt_text}'", conf=conf)
+                                amt_text, how = detect_invoice_amount(page, snippet)
+                                log(f"Montant détecté facture (raw): '{amt_text}' ({how})", conf=conf)
                                 # Normaliser et décider
-                                def parse_amount(s):
-                                    if not s:
-                                        return None
-                                    s = s.replace('\u00A0', '').replace(' ', '')
-                                    s = s.replace('€', '')
-                                    s = s.replace(',', '.')
-                                    try:
-                                        return float(re.search(r"[0-9]+\.?[0-9]*", s).group(0))
-                                    except Exception:
-                                        return None
-                                try:
-                                    import re as _re
-                                    re = _re
-                                except Exception:
-                                    pass
                                 amt_val = parse_amount(amt_text)
                                 renew_status['amount'] = amt_val
                                 if amt_val is None:
                                     log('Impossible de déterminer le montant de la facture, arrêt par sécurité.', conf=conf)
-                                    extras = {'title': 'Montant inconnu', 'description': 'Impossible de déterminer le montant — arrêt par sécurité.', 'status': 'failure', 'url': page.url}
-                                    if screen:
-                                        p = capture_screenshot(page, 'amount_unknown')
-                                        if p:
-                                            extras['screenshots'] = [p]
-                                    send_discord(extras, conf=conf)
+                                    notify.add({'title': 'Montant inconnu', 'description': 'Impossible de déterminer le montant — arrêt par sécurité.', 'status': 'failure', 'url': page.url})
                                     renew_status.update({'status': 'failed', 'reason': 'amount_unknown'})
                                     break
                                 if amt_val > 0.0 and not confirm_pay:
                                     log(f"Facture non gratuite détectée ({amt_val}€) — paiement refusé sans --confirm-pay.", conf=conf)
-                                    extras = {'title': 'Paiement requis', 'description': f'Facture détectée: {amt_text} — pas de paiement automatique sans --confirm-pay.', 'status': 'warning', 'amount': amt_text, 'url': page.url}
-                                    if screen:
-                                        p = capture_screenshot(page, 'payment_required')
-                                        if p:
-                                            extras['screenshots'] = [p]
-                                    send_discord(extras, conf=conf)
+                                    notify.add({'title': 'Paiement requis', 'description': f'Facture détectée: {amt_text} — pas de paiement automatique sans --confirm-pay.', 'status': 'warning', 'amount': amt_text, 'url': page.url})
                                     renew_status.update({'status': 'failed', 'reason': 'payment_required', 'amount': amt_val})
                                     break
                                 # si montant = 0 => on considère la création de facture comme succès (pas de paiement nécessaire)
                                 if amt_val == 0.0:
                                     renew_status.update({'status': 'success', 'reason': 'free_invoice', 'amount': 0.0})
-                                    # capture si demandé
-                                    if screen:
-                                        p = capture_screenshot(page, 'free_invoice')
+                                    # capture intermédiaire (--debug): l'état final est capturé avec le résumé
+                                    if step_shots:
+                                        p = capture_screenshot(page, 'free_invoice', full_page=full_screenshot)
                                         if p:
-                                            send_discord({'title': 'Facture gratuite', 'description': 'Facture gratuite détectée', 'status': 'success', 'url': page.url, 'screenshots': [p]}, conf=conf)
-                            # Détecter message 'Renewal Restricted' avant et après le click renew
+                                            notify.add({'title': 'Facture gratuite', 'description': 'Facture gratuite détectée', 'status': 'success', 'url': page.url, 'screenshots': [p]})
+                            # après le click renew, re-évaluer (page mise à jour)
                             if name == 'renew':
-                                def detect_renewal_restricted(pg):
-                                    # Texte complet visible
-                                    try:
-                                        full = pg.inner_text('body') or ''
-                                    except Exception:
-                                        full = (pg.content() or '')
-                                    low = full.lower()
-                                    checks = [
-                                        'renewal restricted',
-                                        'you can only renew your free service',
-                                        'renouvellement restreint',
-                                        'ne peut être renouvelé',
-                                        'vous ne pouvez renouveler',
-                                        'you can only renew',
-                                    ]
-                                    for c in checks:
-                                        if c in low:
-                                            return True, f"matched_text:{c}"
-                                    # role=alert and common selectors
-                                    for sel in ['[role="alert"]', '.alert', '.alert-danger', '.toast', '.modal', '.modal-body', '.notification', '.notice']:
-                                        try:
-                                            node = pg.query_selector(sel)
-                                            if node:
-                                                t = (node.text_content() or '').lower()
-                                                for c in checks:
-                                                    if c in t:
-                                                        return True, f"sel:{sel}:{c}"
-                                        except Exception:
-                                            pass
-                                    # recherche explicite de titres/h3 contenant le message (ex: modal header)
-                                    try:
-                                        h3 = pg.query_selector("h3:has-text(\"Renewal Restricted\")")
-                                        if h3:
-                                            return True, 'h3:Renewal Restricted'
-                                    except Exception:
-                                        pass
-                                    try:
-                                        # générique: tout h3 avec mot 'renewal' ou 'renouvel'
-                                        h3_any = pg.query_selector_all('h3')
-                                        for n in h3_any:
-                                            try:
-                                                txt = (n.text_content() or '').lower()
-                                                for c in checks:
-                                                    if c in txt:
-                                                        return True, f"h3:{c}"
-                                            except Exception:
-                                                pass
-                                    except Exception:
-                                        pass
-                                    return False, None
-
-                                # check before click
-                                pre_found, pre_why = detect_renewal_restricted(page)
-                                if pre_found:
-                                    log('Renewal Restricted détecté AVANT click renew (' + (pre_why or '') + ').', conf=conf)
-                                    send_discord({'title': 'Renouvellement restreint', 'description': 'Renewal Restricted détecté avant tentative.', 'status': 'failure', 'url': page.url, 'reason': pre_why}, conf=conf)
-                                    renew_status.update({'status': 'failed', 'reason': f'renewal_restricted_before:{pre_why}'})
-                                    if bypass_restriction:
-                                        log('Bypass demandé: on poursuit malgré la restriction (dangerous).', conf=conf)
-                                        send_discord({'title': 'Renouvellement: bypass', 'description': 'Proceeding despite Renewal Restricted due to --bypass-restriction flag. Attention.', 'status': 'warning', 'url': page.url}, conf=conf)
-                                    else:
-                                        break
-                                # after click, re-evaluate (page updated)
-                                post_found, post_why = detect_renewal_restricted(page)
+                                try:
+                                    changed = page.evaluate(RESTRICTION_CHANGED_JS)
+                                except Exception:
+                                    changed = True
+                                # DOM inchangé depuis le contrôle d'avant click: même résultat, pas de nouveau scan
+                                post_found, post_why = detect_renewal_restricted(page, prefer_modal=True) if changed else (pre_found, pre_why)
                                 if post_found:
                                     log('Renewal Restricted détecté APRÈS click renew (' + (post_why or '') + ').', conf=conf)
-                                    send_discord({'title': 'Renouvellement restreint', 'description': 'Renewal Restricted détecté après tentative.', 'status': 'failure', 'url': page.url, 'reason': post_why}, conf=conf)
+                                    notify.add({'title': 'Renouvellement restreint', 'description': 'Renewal Restricted détecté après tentative.', 'status': 'failure', 'url': page.url, 'reason': post_why})
                                     renew_status.update({'status': 'failed', 'reason': f'renewal_restricted_after:{post_why}'})
                                     if bypass_restriction:
                                         log('Bypass demandé: on poursuit malgré la restriction (dangerous).', conf=conf)
-                                        send_discord({'title': 'Renouvellement: bypass', 'description': 'Proceeding despite Renewal Restricted due to --bypass-restriction flag. Attention.', 'status': 'warning', 'url': page.url}, conf=conf)
+                                        notify.add({'title': 'Renouvellement: bypass', 'description': 'Proceeding despite Renewal Restricted due to --bypass-restriction flag. Attention.', 'status': 'warning', 'url': page.url})
                                     else:
                                         break
                         except Exception as e:
                             print(f"Erreur pendant le click '{name}': {e}")
                             # marquer l'erreur et continuer la boucle
-                            renew_status.update({'status': 'failed', 'reason': f"click_error:{name}:{e}"})
-                            send_discord({'title': 'Renouvellement: erreur clic', 'description': f"Erreur pendant le click '{name}': {e}", 'status': 'failure', 'url': page.url}, conf=conf)
+                            # raison bornée à la première ligne (les erreurs Playwright embarquent tout le journal d'appel)
+                            err = str(e).partition('\n')[0]
+                            renew_status.update({'status': 'failed', 'reason': _t(f"click_error:{name}:{err}", 300)})
+                            notify.add({'title': 'Renouvellement: erreur clic', 'description': f"Erreur pendant le click '{name}': {e}", 'status': 'failure', 'url': page.url})
                             # on laisse la boucle tenter la suite si possible
             except Exception as e:
                 print('Erreur pendant run_renew:', e)
             # après la tentative: envoyer un résumé final selon le statut
+            # capture unique de l'état final, jointe au résumé (ou seule si l'échec a déjà été signalé)
+            final_shot = capture_screenshot(page, 'final', full_page=full_screenshot) if screen else None
+            shots = {'screenshots': [final_shot]} if final_shot else {}
+            if renew_status.get('status') == 'success':
+                notify.add({
+                    **shots,
+                    'title': '✅ Renouvellement réussi',
+                    'description': 'Le renouvellement a été effectué avec succès.',
+                    'status': 'success',
+                    'url': page.url,
+                    'amount': renew_status.get('amount'),
+                })
+            elif not str(renew_status.get('reason') or '').startswith(NOTIFIED_FAILURE_REASONS):
+                # défaut: échec ou inconnu (les échecs déjà signalés par un message dédié ne sont pas répétés)
+                reason = renew_status.get('reason') or 'unknown'
+                notify.add({
+                    **shots,
+                    'title': '❌ Erreur lors du renouvellement',
+                    'description': f"Le renouvellement a échoué ou n'a pas été effectué.",
+                    'status': 'failure',
+                    'url': page.url,
+                    'reason': reason,
+                })
+            elif final_shot:
+                notify.add({'title': 'État final', 'description': 'Capture après arrêt du renouvellement', 'status': 'info', 'url': page.url, **shots})
+
+        # persister la session (cf_clearance compris) même si le renouvellement a été refusé, tant qu'elle
+        # est encore authentifiée: pas après un challenge ni une redirection vers la page de connexion
+        challenged = run_renew and renew_status.get('reason') == 'security_challenge'
+        if not challenged and '/login' not in page.url:
+            save_storage_state(context, state_path, conf=conf)
+    finally:
+        context.close()
+        if own_notify:
+            notify.flush()
+    return renew_status if run_renew else None
+
+
+def _run_service(browser, svc_conf, opts):
+    # notifications du service envoyées groupées, y compris si le traitement lève une exception
+    notify = DiscordBatcher(svc_conf)
+    try:
+        status = process_service(browser, svc_conf, notify=notify, **opts)
+        if status and status.get('status') == 'success' and status.get('reason') in CONFIRMED_RENEW_REASONS:
+            record_last_run(svc_conf, svc_conf['service_manage_url'])
+    except Exception as e:
+        log(f"Erreur service {svc_conf.get('service_manage_url')}: {e}", conf=svc_conf)
+    finally:
+        notify.flush()
+
+
+def _run_service_worker(svc_conf, opts):
+    """Worker de ThreadPoolExecutor: l'API sync de Playwright est liée à son thread, chaque worker
+    a donc son propre driver et se connecte (CDP) ou lance son navigateur."""
+    from playwright.sync_api import sync_playwright
+    with sync_playwright() as p:
+        browser, via_cdp = get_browser(p, svc_conf, headful=opts.get('headful'))
+        _run_service(browser, svc_conf, opts)
+        if not via_cdp:
+            browser.close()
+
+
+def main(run_renew=False, headful=False, timeout_ms=60000, use_config_cookies=True, bypass_restriction=False, confirm_pay=False, screen=False, debug=False, force=False, dry=False, full_screenshot=False, reset_session=False):
+    conf = load_config()
+    _open_log_file(conf)
+    if debug:
+        # installé depuis le thread principal (signal.signal), avant les éventuels workers
+        _install_debug_resume()
+    services = list(_iter_services(conf))
+    if not all(s.get('service_manage_url') for s in services):
+        print('Erreur: service_manage_url manquant dans config.json')
+        return 2
+
+    # --reset-session: repartir des cookies de la config (session sauvegardée expirée ou corrompue)
+    if reset_session:
+        for svc_conf in services:
+            state_path = _storage_state_path(svc_conf)
             try:
-                if renew_status.get('status') == 'success':
-                    send_discord({
-                        'title': '✅ Renouvellement réussi',
-                        'description': 'Le renouvellement a été effectué avec succès.',
-                        'status': 'success',
-                        'url': page.url,
-                        'amount': renew_status.get('amount'),
-                        'fields': [
-                            {'name': 'URL', 'value': page.url, 'inline': False},
-                            {'name': 'Montant', 'value': str(renew_status.get('amount') or '—'), 'inline': True},
-                        ]
-                    }, conf=conf)
-                else:
-                    # défaut: échec ou inconnu
-                    reason = renew_status.get('reason') or 'unknown'
-                    send_discord({
-                        'title': '❌ Erreur lors du renouvellement',
-                        'description': f"Le renouvellement a échoué ou n'a pas été effectué.",
-                        'status': 'failure',
-                        'url': page.url,
-                        'reason': reason,
-                        'json': {'renew_status': renew_status},
-                        'fields': [
-                            {'name': 'URL', 'value': page.url, 'inline': False},
-                            {'name': 'Raison', 'value': str(reason), 'inline': False},
-                        ]
-                    }, conf=conf)
-            except Exception:
+                state_path.unlink()
+                log(f"Session supprimée: {state_path}", conf=conf)
+            except FileNotFoundError:
                 pass
 
-        browser.close()
+    # ignorer les services renouvelés récemment (simple lecture d'un JSON, sans lancer Chromium)
+    if run_renew and not force:
+        # lu dans le fichier de chaque service (celui où record_last_run écrit), une fois par fichier
+        runs_by_path = {}
+        todo = []
+        for svc_conf in services:
+            path = _last_run_path(svc_conf)
+            if path not in runs_by_path:
+                runs_by_path[path] = _load_last_runs(svc_conf)
+            if renewed_recently(svc_conf, svc_conf['service_manage_url'], runs=runs_by_path[path]):
+                log(f"Renouvellement récent pour {svc_conf['service_manage_url']} (< {svc_conf.get('min_days_between_runs')} jours), ignoré.", conf=conf)
+            else:
+                todo.append(svc_conf)
+        services = todo
+        if not services:
+            return 0
+
+    # export des cookies: un simple GET suffit tant que la page n'exige pas de JS
+    if dry and not run_renew:
+        services = [svc_conf for svc_conf in services if not dry_fetch_cookies(svc_conf)]
+        if not services:
+            return 0
+
+    opts = dict(run_renew=run_renew, headful=headful, timeout_ms=timeout_ms, use_config_cookies=use_config_cookies, bypass_restriction=bypass_restriction, confirm_pay=confirm_pay, screen=screen, debug=debug, full_screenshot=full_screenshot)
+    workers = min(int(conf.get('max_parallel') or 1), len(services))
+    if workers > 1:
+        # services traités en parallèle, un contexte isolé chacun (avec cdp_endpoint/cdp_daemon,
+        # tous les workers partagent le même Chromium)
+        from concurrent.futures import ThreadPoolExecutor
+        from playwright.sync_api import sync_playwright
+        with sync_playwright() as p:
+            # sans Chromium partagé configuré, chaque worker lancerait le sien: on lance un Chromium
+            # éphémère pour tout le run et les workers s'y connectent (un seul démarrage à froid)
+            shared = None
+            run_profile = None
+            if not headful and not (os.environ.get('HIDEN_CDP_URL') or conf.get('cdp_endpoint') or conf.get('cdp_daemon')):
+                try:
+                    run_profile = tempfile.mkdtemp(prefix='hc-run-')
+                    shared = _spawn_chromium(p, conf, run_profile)
+                    services = [dict(svc_conf, cdp_endpoint=shared[0]) for svc_conf in services]
+                except Exception as e:
+                    log(f"Chromium partagé indisponible, un navigateur par worker: {e}", conf=conf)
+            try:
+                with ThreadPoolExecutor(max_workers=workers) as ex:
+                    list(ex.map(_run_service_worker, services, [opts] * len(services)))
+            finally:
+                if shared:
+                    shared[1].terminate()
+                    shared[1].wait(timeout=10)
+                if run_profile:
+                    import shutil
+                    shutil.rmtree(run_profile, ignore_errors=True)
+        return 0
+
+    from playwright.sync_api import sync_playwright
+
+    with sync_playwright() as p:
+        # un seul navigateur pour tous les services: le coût de lancement n'est payé qu'une fois
+        browser, via_cdp = get_browser(p, conf, headful=headful)
+        for svc_conf in services:
+            _run_service(browser, svc_conf, opts)
+        # en mode CDP le Chromium partagé doit rester vivant: seuls nos contextes ont été fermés
+        if not via_cdp:
+            browser.close()
     return 0
 
 
 if __name__ == '__main__':
     ap = argparse.ArgumentParser()
+    ap.add_argument('--dry', action='store_true', help='Exporter les cookies via une simple requête HTTP, sans lancer Chromium (sauf challenge)')
     ap.add_argument('--run-renew', action='store_true', help='Tenter d appuyer sur le bouton Renouveler (peut être destructif)')
     ap.add_argument('--headful', action='store_true', help='Lancer le navigateur en mode non-headless (utile pour debug/intervention)')
     ap.add_argument('--timeout-ms', type=int, default=60000, help='Timeout de navigation en ms')
     ap.add_argument('--debug', action='store_true', help='Mode debug: demande de validation avant chaque étape (conseillé avec --headful)')
-    ap.add_argument('--screen', action='store_true', help='Prendre des captures d écran à chaque étape et les envoyer au webhook Discord')
+    ap.add_argument('--screen', action='store_true', help='Capture d écran de l état final envoyée au webhook Discord (à chaque étape avec --debug)')
+    ap.add_argument('--full-screenshot', action='store_true', help='Avec --screen: capturer la page entière en PNG au lieu de la zone visible en JPEG')
+    ap.add_argument('--reset-session', action='store_true', help='Supprimer la session sauvegardée (paths.storage_state) et repartir des cookies de config.json')
     ap.add_argument('--bypass-restriction', action='store_true', help='Tenter malgré Renewal Restricted (dangerous)')
     ap.add_argument('--confirm-pay', action='store_true', help='Autoriser le clic final Payer (nécessaire si montant > 0)')
+    ap.add_argument('--force', action='store_true', help='Ignorer min_days_between_runs et tenter le renouvellement quand même')
     args = ap.parse_args()
     # Par défaut on injecte les cookies depuis config.json; il faut explicitement fournir --run-renew pour effectuer la séquence de paiement
-    rc = main(run_renew=args.run_renew, headful=args.headful, timeout_ms=args.timeout_ms, use_config_cookies=True, bypass_restriction=args.bypass_restriction, confirm_pay=args.confirm_pay, screen=args.screen, debug=args.debug)
+    rc = main(run_renew=args.run_renew, headful=args.headful, timeout_ms=args.timeout_ms, use_config_cookies=True, bypass_restriction=args.bypass_restriction, confirm_pay=args.confirm_pay, screen=args.screen, debug=args.debug, force=args.force, dry=args.dry, full_screenshot=args.full_screenshot, reset_session=args.reset_session)
+    # notifications encore en file: envoyées avant de rendre la main
+    discord_drain()
     sys.exit(rc)